@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+自适应角度扫描模块
+在 (alpha, theta) 平面上从粗网格出发，只对角点结果不一致的单元格递归四分细分，
+从而把射线集中在"命中/未命中"切换、落点跳变或距离突变的边界附近。
+每一层细分的所有新方向会合并为一次向量化的射线追踪调用。
+"""
+
+import argparse
+import json
+from datetime import datetime
+from pathlib import Path
+import sys
+
+import numpy as np
+
+# 导入项目内的工具模块
+from geometry_utils import get_direction_from_angles
+from ray_tracing import load_scene, trace_rays
+from config import (
+    RESULTS_DIR,
+    ADAPTIVE_ALPHA_RANGE,
+    ADAPTIVE_THETA_RANGE,
+    ADAPTIVE_COARSE_CELLS,
+    ADAPTIVE_MAX_DEPTH,
+    ADAPTIVE_MAX_RAYS,
+    ADAPTIVE_DISTANCE_FACTOR,
+    ADAPTIVE_LOCATION_FACTOR,
+)
+
+# 入射角余弦的下限，避免掠射时 tan / 1/cos 发散
+_MIN_INCIDENCE_COS = 0.05
+
+def _angle_key(alpha_deg, theta_deg):
+    """
+    角度采样点的缓存键；theta 按 360° 取模，避免首尾重复追踪。
+    alpha 为 0° 或 180° 时方向与 theta 无关，theta 统一记为 0。
+    """
+    alpha_deg = round(float(alpha_deg), 9)
+    if alpha_deg % 180.0 == 0:
+        return (alpha_deg, 0.0)
+    return (alpha_deg, round(float(theta_deg) % 360.0, 9))
+
+def _cell_corners(cell):
+    """返回单元格 (alpha0, alpha1, theta0, theta1) 的四个角点。"""
+    a0, a1, t0, t1 = cell
+    return [(a0, t0), (a0, t1), (a1, t0), (a1, t1)]
+
+def _split_cell(cell):
+    """将单元格在 alpha / theta 两个方向上各二分，得到四个子单元格。"""
+    a0, a1, t0, t1 = cell
+    am, tm = (a0 + a1) / 2.0, (t0 + t1) / 2.0
+    return [(a0, am, t0, tm), (a0, am, tm, t1), (am, a1, t0, tm), (am, a1, tm, t1)]
+
+def score_cells(corner_hit, corner_distance, corner_location, corner_normal, corner_direction,
+                distance_factor, location_factor):
+    """
+    计算每个单元格角点结果的不一致程度。
+
+    参数:
+    corner_hit (np.ndarray): (C, 4, N) 角点命中标志。
+    corner_distance (np.ndarray): (C, 4, N) 角点命中距离 (未命中为 NaN)。
+    corner_location (np.ndarray): (C, 4, N, 3) 角点命中位置 (未命中为 NaN)。
+    corner_normal (np.ndarray): (C, 4, N, 3) 角点命中面的法向 (未命中为 NaN)。
+    corner_direction (np.ndarray): (C, 4, 3) 角点的射线方向。
+    distance_factor (float): 距离跳变容差相对于"距离 × 张角 × (1 + tan(入射角))"的倍数。
+    location_factor (float): 落点跳变容差相对于"距离 × 张角 / cos(入射角)"的倍数。
+
+    返回:
+    np.ndarray: (C,) 每个单元格中角点结果不一致的源点数量，0 表示无需细分。
+    """
+    # 1. 命中/未命中切换
+    disagree = corner_hit.any(axis=1) & ~corner_hit.all(axis=1)
+
+    # 以下判据只对四个角点都命中的源点有意义
+    all_hit = corner_hit.all(axis=1)
+
+    # 平滑表面上角点结果的预期变化与 距离 × 张角 成正比，并随入射角增大；
+    # 两个容差都随单元格尺寸缩小，因此平滑表面不会被反复细分
+    cos_angle = np.einsum('cid,cjd->cij', corner_direction, corner_direction)
+    cell_angle = np.arccos(np.clip(cos_angle, -1.0, 1.0)).max(axis=(1, 2))[:, np.newaxis]
+    with np.errstate(invalid='ignore'):
+        incidence_cos = np.abs(np.einsum('cid,cind->cin', corner_direction, corner_normal))
+        min_cos = np.clip(np.min(incidence_cos, axis=1), _MIN_INCIDENCE_COS, 1.0)
+        max_tan = np.sqrt(1.0 - min_cos ** 2) / min_cos
+        scale = cell_angle * np.max(corner_distance, axis=1)
+
+        # 2. 距离突变
+        jump = np.ptp(corner_distance, axis=1) > distance_factor * scale * (1.0 + max_tan)
+        disagree |= all_hit & jump
+
+        # 3. 落点跳变
+        spread = np.linalg.norm(
+            corner_location[:, :, np.newaxis] - corner_location[:, np.newaxis, :], axis=-1
+        ).max(axis=(1, 2))
+        disagree |= all_hit & (spread > location_factor * scale / min_cos)
+
+    return disagree.sum(axis=1)
+
+def run_adaptive_sweep(source_organ_name, target_organ_name,
+                       alpha_range=ADAPTIVE_ALPHA_RANGE,
+                       theta_range=ADAPTIVE_THETA_RANGE,
+                       coarse_cells=ADAPTIVE_COARSE_CELLS,
+                       max_depth=ADAPTIVE_MAX_DEPTH,
+                       max_rays=ADAPTIVE_MAX_RAYS,
+                       distance_factor=ADAPTIVE_DISTANCE_FACTOR,
+                       location_factor=ADAPTIVE_LOCATION_FACTOR):
+    """
+    执行自适应角度扫描。
+
+    从 coarse_cells 指定的粗网格出发，每一层只细分角点结果不一致的单元格，
+    直到没有需要细分的单元格、达到 max_depth 或射线总数达到 max_rays 为止。
+    预算不足时优先细分不一致源点数最多的单元格，放不下的单元格保留为未解决的边界。
+
+    返回:
+    dict: 包含扫描参数、所有采样方向的结果以及最终的边界单元格。
+    """
+    print("--- 开始自适应角度扫描 ---")
+
+    scene = load_scene(source_organ_name, target_organ_name)
+    skin_mesh = scene["skin_mesh"]
+    source_points = scene["source_points"]
+    n_points = len(source_points)
+
+    # 所有已追踪的采样方向；行号即采样索引
+    sample_index = {}
+    samples = []
+    sample_depth = []
+    direction_rows = []
+    hit_rows, face_rows, distance_rows, location_rows, normal_rows = [], [], [], [], []
+
+    def trace_level(angles, depth):
+        """将本层所有新方向合并为一次射线追踪。"""
+        directions = np.array([get_direction_from_angles(a, t) for a, t in angles])
+        traced = trace_rays(skin_mesh, source_points, directions)
+        direction_rows.append(directions)
+        for angle in angles:
+            sample_index[_angle_key(*angle)] = len(samples)
+            samples.append(angle)
+            sample_depth.append(depth)
+        hit_rows.append(traced["hit"])
+        face_rows.append(traced["face_id"])
+        distance_rows.append(traced["distance"])
+        location_rows.append(traced["location"])
+        normal = skin_mesh.face_normals[np.maximum(traced["face_id"], 0)]
+        normal[~traced["hit"]] = np.nan
+        normal_rows.append(normal)
+        print(f"  - 第 {depth} 层: 追踪 {len(angles)} 个方向 ({len(angles) * n_points} 条射线)")
+
+    def new_corner_angles(cells, queued):
+        """返回 cells 的角点中既未追踪过、也不在 queued 中的方向 (按键去重)。"""
+        added = {}
+        for cell in cells:
+            for angle in _cell_corners(cell):
+                key = _angle_key(*angle)
+                if key not in sample_index and key not in queued and key not in added:
+                    added[key] = angle
+        return added
+
+    # 1. 粗网格
+    alpha_edges = np.linspace(alpha_range[0], alpha_range[1], coarse_cells[0] + 1)
+    theta_edges = np.linspace(theta_range[0], theta_range[1], coarse_cells[1] + 1)
+    cells = [
+        (float(alpha_edges[i]), float(alpha_edges[i + 1]), float(theta_edges[j]), float(theta_edges[j + 1]))
+        for i in range(coarse_cells[0]) for j in range(coarse_cells[1])
+    ]
+    coarse = new_corner_angles(cells, {})
+    if len(coarse) * n_points > max_rays:
+        raise ValueError(
+            f"初始粗网格需要 {len(coarse) * n_points} 条射线，超过射线预算 {max_rays}，"
+            f"请减小 coarse_cells 或增大 max_rays。"
+        )
+    trace_level(list(coarse.values()), 0)
+    rays_traced = len(samples) * n_points
+
+    depth = 0
+    budget_exhausted = False
+    # 因预算不足而未能细分的边界单元格，保留在最终结果中
+    unresolved = []
+    while True:
+        hit = np.concatenate(hit_rows)
+        distance = np.concatenate(distance_rows)
+        location = np.concatenate(location_rows)
+        normal = np.concatenate(normal_rows)
+        direction = np.concatenate(direction_rows)
+
+        # 2. 评估当前层单元格的角点一致性
+        corner_idx = np.array([
+            [sample_index[_angle_key(*angle)] for angle in _cell_corners(cell)] for cell in cells
+        ])
+        scores = score_cells(hit[corner_idx], distance[corner_idx], location[corner_idx],
+                             normal[corner_idx], direction[corner_idx], distance_factor, location_factor)
+        boundary = [(cell, int(score)) for cell, score in zip(cells, scores) if score > 0]
+
+        if not boundary or depth >= max_depth or budget_exhausted:
+            break
+
+        # 3. 按不一致程度从高到低选择要细分的单元格；放不下的跳过，
+        #    后面与已排队方向共享角点的单元格仍可能放得下
+        boundary.sort(key=lambda item: item[1], reverse=True)
+        refined = []
+        pending = {}
+        skipped = []
+        for cell, score in boundary:
+            children = _split_cell(cell)
+            added = new_corner_angles(children, pending)
+            if rays_traced + (len(pending) + len(added)) * n_points > max_rays:
+                budget_exhausted = True
+                skipped.append((cell, score))
+                continue
+            pending.update(added)
+            refined.extend(children)
+        if not refined:
+            break
+        unresolved.extend(skipped)
+
+        depth += 1
+        if pending:
+            trace_level(list(pending.values()), depth)
+            rays_traced += len(pending) * n_points
+        cells = refined
+
+    boundary = boundary + unresolved
+    if budget_exhausted:
+        print(f"  - 已达到射线预算上限 ({max_rays})，停止细分。")
+    print(f"--- 扫描结束: 共 {len(samples)} 个方向, {rays_traced} 条射线, {len(boundary)} 个边界单元格 ---")
+
+    face_id = np.concatenate(face_rows)
+    sample_results = []
+    for k, (alpha_deg, theta_deg) in enumerate(samples):
+        sample_results.append({
+            "alpha_deg": alpha_deg,
+            "theta_deg": theta_deg,
+            "depth": sample_depth[k],
+            "rays_that_hit": int(hit[k].sum()),
+            "hit": hit[k].tolist(),
+            "face_id": [int(f) if h else None for f, h in zip(face_id[k], hit[k])],
+            "distance": [float(d) if h else None for d, h in zip(distance[k], hit[k])],
+            "intersection_coord": [loc.tolist() if h else None for loc, h in zip(location[k], hit[k])],
+        })
+
+    return {
+        "scene": scene,
+        "parameters": {
+            "alpha_range": list(alpha_range),
+            "theta_range": list(theta_range),
+            "coarse_cells": list(coarse_cells),
+            "max_depth": max_depth,
+            "max_rays": max_rays,
+            "distance_factor": distance_factor,
+            "location_factor": location_factor,
+        },
+        "summary": {
+            "total_source_points": n_points,
+            "directions_traced": len(samples),
+            "rays_traced": rays_traced,
+            "depth_reached": depth,
+            "budget_exhausted": budget_exhausted,
+        },
+        "samples": sample_results,
+        "boundary_cells": [
+            {"alpha_range": [cell[0], cell[1]], "theta_range": [cell[2], cell[3]], "disagreeing_points": score}
+            for cell, score in boundary
+        ],
+    }
+
+def save_sweep_results(output_path, sweep):
+    """将扫描结果保存为单个 JSON 文件。"""
+    Path(output_path).mkdir(parents=True, exist_ok=True)
+    scene = sweep["scene"]
+
+    metadata = {
+        'timestamp': datetime.now().isoformat(),
+        'parameters': sweep["parameters"],
+        'input_files': {
+            'skin_mesh': str(Path(scene["skin_mesh_path"]).name),
+            'key_points': str(Path(scene["key_points_path"]).name)
+        },
+        'results_summary': sweep["summary"],
+        'source_points': [
+            {"source_point_index": i, "source_point_name": name, "source_coord": coord.tolist()}
+            for i, (name, coord) in enumerate(zip(scene["point_names"], scene["source_points"]))
+        ],
+        'samples': sweep["samples"],
+        'boundary_cells': sweep["boundary_cells"]
+    }
+
+    json_path = Path(output_path) / "adaptive_sweep_result.json"
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=4, ensure_ascii=False)
+    print(f"  - 扫描结果已保存: {json_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="在 (alpha, theta) 平面上执行自适应细分的射线追踪扫描。"
+    )
+    parser.add_argument("--source", required=True, help="源器官的名称 (e.g., 'heart', 'thyroid').")
+    parser.add_argument("--target", default="skin", help="目标器官的名称 (默认为 'skin').")
+    parser.add_argument("--alpha_range", type=float, nargs=2, default=ADAPTIVE_ALPHA_RANGE, help="倾斜角扫描范围，单位：度。")
+    parser.add_argument("--theta_range", type=float, nargs=2, default=ADAPTIVE_THETA_RANGE, help="方位角扫描范围，单位：度。")
+    parser.add_argument("--coarse_cells", type=int, nargs=2, default=ADAPTIVE_COARSE_CELLS, help="初始粗网格在 alpha / theta 方向上的单元格数。")
+    parser.add_argument("--max_depth", type=int, default=ADAPTIVE_MAX_DEPTH, help="最大细分层数。")
+    parser.add_argument("--max_rays", type=int, default=ADAPTIVE_MAX_RAYS, help="射线总预算。")
+    parser.add_argument("--distance_factor", type=float, default=ADAPTIVE_DISTANCE_FACTOR, help="距离跳变容差相对于 距离 × 单元格张角 × (1 + tan(入射角)) 的倍数。")
+    parser.add_argument("--location_factor", type=float, default=ADAPTIVE_LOCATION_FACTOR, help="落点跳变容差相对于 距离 × 单元格张角 / cos(入射角) 的倍数。")
+    parser.add_argument("--output_dir", default=None, help="保存结果的自定义目录。默认为 'output/results/<source>_to_<target>/adaptive_sweep/'")
+
+    args = parser.parse_args()
+
+    sweep = run_adaptive_sweep(
+        args.source,
+        args.target,
+        alpha_range=tuple(args.alpha_range),
+        theta_range=tuple(args.theta_range),
+        coarse_cells=tuple(args.coarse_cells),
+        max_depth=args.max_depth,
+        max_rays=args.max_rays,
+        distance_factor=args.distance_factor,
+        location_factor=args.location_factor
+    )
+
+    if args.output_dir:
+        output_path = args.output_dir
+    else:
+        output_path = RESULTS_DIR / f"{args.source}_to_{args.target}" / "adaptive_sweep"
+
+    save_sweep_results(output_path, sweep)
+
+if __name__ == "__main__":
+    sys.path.append(str(Path(__file__).resolve().parent))
+    main()
@@ -45,4 +45,30 @@ SKIN_TRANSFORM_PARAMS_PATH = get_paths("skin")["transform_params"]
 
 # --- Default Ray-Tracing Parameters ---
 DEFAULT_ALPHA_DEG = 30.0
-DEFAULT_THETA_DEG = 0.0 
\ No newline at end of file
+DEFAULT_THETA_DEG = 0.0 
+
+# --- Adaptive Angular Sweep Parameters ---
+# 初始粗网格覆盖的角度范围 (度)
+ADAPTIVE_ALPHA_RANGE = (0.0, 90.0)
+ADAPTIVE_THETA_RANGE = (0.0, 360.0)
+# 初始粗网格在 alpha / theta 方向上的单元格数
+ADAPTIVE_COARSE_CELLS = (3, 4)
+# 最大细分层数与射线总预算 (射线数 = 方向数 × 源点数)
+ADAPTIVE_MAX_DEPTH = 4
+ADAPTIVE_MAX_RAYS = 200000
+# 以下两个倍数均无量纲，容差随命中距离与单元格张角 (弧度) 同比缩放，与模型单位无关。
+# 平滑表面上，张角 φ 内的距离变化约为 距离 × φ × tan(入射角)，
+# 距离跳变容差 = 该倍数 × 最大命中距离 × φ × (1 + tan(最大入射角))
+ADAPTIVE_DISTANCE_FACTOR = 1.0
+# 平滑表面上落点间距约为 距离 × φ / cos(入射角)，
+# 落点跳变容差 = 该倍数 × 最大命中距离 × φ / cos(最大入射角)
+ADAPTIVE_LOCATION_FACTOR = 2.0
+
+# --- Ray-Tracing Pipeline Parameters ---
+# 加载阶段最多预取的场景数 (每个场景包含完整的目标网格)
+PIPELINE_PREFETCH_SCENES = 1
+# 追踪阶段每次批量求交的方向数
+PIPELINE_TRACE_BATCH = 8
+# 后台写入线程数，以及允许排队等待写入的结果数上限
+PIPELINE_WRITER_THREADS = 4
+PIPELINE_MAX_PENDING_WRITES = 8
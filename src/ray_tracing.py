@@ -11,13 +11,26 @@ import numpy as np
 import argparse
 import os
 import json
+import queue
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import product
 from pathlib import Path
 import sys
 
 # 导入项目内的工具模块
 from geometry_utils import get_direction_from_angles
-from config import get_paths
+from config import (
+    get_paths,
+    RESULTS_DIR,
+    PIPELINE_PREFETCH_SCENES,
+    PIPELINE_TRACE_BATCH,
+    PIPELINE_WRITER_THREADS,
+    PIPELINE_MAX_PENDING_WRITES,
+)
 
 def load_key_points(file_path):
     """从OBJ文件中加载顶点作为关键点。"""
@@ -29,12 +42,11 @@ def load_key_points(file_path):
                 points.append([float(p) for p in parts[1:4]])
     return np.array(points)
 
-def run_ray_tracing(source_organ_name, target_organ_name, alpha_deg, theta_deg):
+def load_scene(source_organ_name, target_organ_name):
     """
-    执行从源器官关键点到目标器官模型的射线追踪。
+    加载一次实验所需的目标模型、源关键点及其名称。
+    返回的字典可在多个射线方向之间复用，避免重复读取模型。
     """
-    print("--- 开始射线追踪实验 ---")
-    
     # 1. Get all necessary paths using the new config system
     source_paths = get_paths(source_organ_name)
     target_paths = get_paths(target_organ_name)
@@ -65,39 +77,98 @@ def run_ray_tracing(source_organ_name, target_organ_name, alpha_deg, theta_deg):
     else:
         point_names = [f"Point_{i+1}" for i in range(len(source_points))]
 
-    ray_direction = get_direction_from_angles(alpha_deg, theta_deg)
+    return {
+        "skin_mesh": skin_mesh,
+        "source_points": source_points,
+        "point_names": point_names,
+        "skin_mesh_path": skin_mesh_path,
+        "key_points_path": key_points_path,
+        "mapping_path": mapping_path,
+    }
+
+def trace_rays(skin_mesh, source_points, ray_directions):
+    """
+    对 M 个射线方向 × N 个源点一次性批量求交，每条射线只保留最近的交点。
+
+    参数:
+    skin_mesh (trimesh.Trimesh): 目标模型。
+    source_points (np.ndarray): (N, 3) 源点坐标。
+    ray_directions (np.ndarray): (M, 3) 射线方向。
+
+    返回:
+    dict: 'hit' (M, N) 布尔数组，'face_id' (M, N) 整数数组 (未命中为 -1)，
+          'distance' (M, N) 与 'location' (M, N, 3) 浮点数组 (未命中为 NaN)。
+    """
+    source_points = np.asarray(source_points, dtype=float)
+    ray_directions = np.atleast_2d(np.asarray(ray_directions, dtype=float))
+    n_dirs, n_points = len(ray_directions), len(source_points)
+    n_rays = n_dirs * n_points
+
+    # 射线按 (方向, 源点) 展平，第 k 条射线对应 (k // N, k % N)
+    ray_origins = np.tile(source_points, (n_dirs, 1))
     locations, index_ray, index_tri = skin_mesh.ray.intersects_location(
-        ray_origins=source_points,
-        ray_directions=np.tile(ray_direction, (len(source_points), 1))
+        ray_origins=ray_origins,
+        ray_directions=np.repeat(ray_directions, n_points, axis=0)
     )
-    
-    results = []
-    hit_map = {i: [] for i in range(len(source_points))}
-    for loc, ray_idx, tri_idx in zip(locations, index_ray, index_tri):
-        hit_map[ray_idx].append((loc, tri_idx))
 
+    hit = np.zeros(n_rays, dtype=bool)
+    face_id = np.full(n_rays, -1, dtype=int)
+    distance = np.full(n_rays, np.nan)
+    location = np.full((n_rays, 3), np.nan)
+    if len(index_ray):
+        distances = np.linalg.norm(locations - ray_origins[index_ray], axis=1)
+        # 先按射线、再按距离排序，每条射线的第一个元素即为最近交点
+        order = np.lexsort((distances, index_ray))
+        hit_rays, first = np.unique(index_ray[order], return_index=True)
+        closest = order[first]
+        hit[hit_rays] = True
+        face_id[hit_rays] = index_tri[closest]
+        distance[hit_rays] = distances[closest]
+        location[hit_rays] = locations[closest]
+
+    return {
+        "hit": hit.reshape(n_dirs, n_points),
+        "face_id": face_id.reshape(n_dirs, n_points),
+        "distance": distance.reshape(n_dirs, n_points),
+        "location": location.reshape(n_dirs, n_points, 3),
+    }
+
+def build_results(source_points, point_names, traced, direction_index=0):
+    """将 trace_rays 的某一个方向的输出整理为逐点的结果列表。"""
+    results = []
     for i in range(len(source_points)):
         result_entry = {
             "source_point_index": i, "source_point_name": point_names[i],
             "source_coord": source_points[i].tolist(), "hit": False,
             "intersection_coord": None, "face_id": None, "distance": None
         }
-        if i in hit_map and hit_map[i]:
-            locations_only = np.array([item[0] for item in hit_map[i]])
-            distances = np.linalg.norm(locations_only - source_points[i], axis=1)
-            closest_hit_index = np.argmin(distances)
+        if traced["hit"][direction_index, i]:
             result_entry.update({
-                "intersection_coord": locations_only[closest_hit_index].tolist(),
-                "face_id": int(hit_map[i][closest_hit_index][1]),
-                "distance": distances[closest_hit_index], "hit": True
+                "intersection_coord": traced["location"][direction_index, i].tolist(),
+                "face_id": int(traced["face_id"][direction_index, i]),
+                "distance": float(traced["distance"][direction_index, i]), "hit": True
             })
         results.append(result_entry)
+    return results
+
+def run_ray_tracing(source_organ_name, target_organ_name, alpha_deg, theta_deg):
+    """
+    执行从源器官关键点到目标器官模型的射线追踪。
+    """
+    print("--- 开始射线追踪实验 ---")
+    
+    scene = load_scene(source_organ_name, target_organ_name)
+
+    ray_direction = get_direction_from_angles(alpha_deg, theta_deg)
+    traced = trace_rays(scene["skin_mesh"], scene["source_points"], ray_direction[np.newaxis])
+    results = build_results(scene["source_points"], scene["point_names"], traced)
         
     return results, ray_direction
 
-def save_results(output_path, results, params, ray_direction, skin_mesh_path, key_points_path, mapping_path=None):
+def save_results(output_path, results, params, ray_direction, skin_mesh_path, key_points_path, mapping_path=None, verbose=True):
     """
     按照项目规范保存所有结果。
+    verbose 为 False 时不打印逐个文件的保存信息 (由调用方负责汇报最终路径)。
     """
     # 确保输出目录存在
     Path(output_path).mkdir(parents=True, exist_ok=True)
@@ -125,7 +196,8 @@ def save_results(output_path, results, params, ray_direction, skin_mesh_path, ke
     json_path = Path(output_path) / "ray_trace_result.json"
     with open(json_path, 'w', encoding='utf-8') as f:
         json.dump(metadata, f, indent=4, ensure_ascii=False)
-    print(f"  - 元数据已保存: {json_path}")
+    if verbose:
+        print(f"  - 元数据已保存: {json_path}")
     
     # 提取有效的交点
     valid_intersections = [r for r in results if r['hit']]
@@ -138,7 +210,8 @@ def save_results(output_path, results, params, ray_direction, skin_mesh_path, ke
             for r in valid_intersections:
                 p = r['intersection_coord']
                 f.write(f"v {p[0]:.6f} {p[1]:.6f} {p[2]:.6f} # name: {r['source_point_name']}, face_id: {r['face_id']}\n")
-        print(f"  - 交点OBJ已保存: {obj_path}")
+        if verbose:
+            print(f"  - 交点OBJ已保存: {obj_path}")
 
     # 4. 保存源点-交点对 OBJ 文件
     if valid_intersections:
@@ -154,65 +227,246 @@ def save_results(output_path, results, params, ray_direction, skin_mesh_path, ke
                 f.write(f"v {t[0]:.6f} {t[1]:.6f} {t[2]:.6f} # Target\n")
                 f.write(f"l {vertex_counter} {vertex_counter + 1}\n")
                 vertex_counter += 2
-        print(f"  - 射线对OBJ已保存: {pairs_path}")
+        if verbose:
+            print(f"  - 射线对OBJ已保存: {pairs_path}")
     
-    print("--- 结果保存完毕 ---")
+    if verbose:
+        print("--- 结果保存完毕 ---")
+
+
+def save_results_atomic(output_path, *args, **kwargs):
+    """
+    与 save_results 相同，但先写入同级的唯一临时目录，全部文件写完后再整体重命名。
+    已有的结果目录先被移到一旁，替换成功后才删除，因此任何时刻都不会出现
+    不完整的 alpha_X_theta_Y 目录，也不会在替换过程中丢失旧结果。
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    # 用 mkdir 创建唯一命名的临时目录，使目录权限与直接创建时一样遵循 umask
+    tmp_path = output_path.with_name(f".{output_path.name}.{uuid.uuid4().hex}")
+    tmp_path.mkdir()
+    old_path = tmp_path.with_name(f"{tmp_path.name}.old")
+    try:
+        save_results(tmp_path, *args, verbose=False, **kwargs)
+        if output_path.exists():
+            os.replace(output_path, old_path)
+        try:
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            if old_path.exists():
+                os.replace(old_path, output_path)
+            raise
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    shutil.rmtree(old_path, ignore_errors=True)
+    saved_files = ", ".join(sorted(p.name for p in output_path.iterdir()))
+    print(f"  - 结果目录已就绪: {output_path} ({saved_files})")
+
+_LOADER_DONE = object()
+
+def _scene_loader(sources, target_organ_name, scene_queue, stop_event):
+    """加载阶段：依次加载每个源器官的场景并放入有界队列，队列满时阻塞。"""
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                scene_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
+    try:
+        for source in sources:
+            scene = load_scene(source, target_organ_name)
+            if not put((source, scene)):
+                return
+    except BaseException as e:
+        put(e)
+        return
+    put(_LOADER_DONE)
+
+def run_pipeline(sources, target_organ_name, angles, output_dir=None,
+                 prefetch_scenes=PIPELINE_PREFETCH_SCENES,
+                 trace_batch=PIPELINE_TRACE_BATCH,
+                 writer_threads=PIPELINE_WRITER_THREADS,
+                 max_pending_writes=PIPELINE_MAX_PENDING_WRITES):
+    """
+    以流水线方式执行多组射线追踪实验：
+    加载线程预取下一个源器官的场景，主线程按批次追踪射线，
+    写入线程池在后台整理并保存结果。
+
+    两个有界缓冲区提供背压：场景队列最多预取 prefetch_scenes 个场景，
+    等待写入的结果最多 max_pending_writes 个，超出时追踪阶段会阻塞。
+    重复的源器官和 (alpha, theta) 组合只执行一次。
+
+    加载或追踪阶段出错时，停止加载，并先把已追踪、排队中的结果全部写出再抛出异常；
+    写入阶段出错时，取消尚未开始的写入，等待进行中的写入结束后抛出异常。
+    两种情况下都会对照完整任务列表，分别列出写入失败和未执行的方向。每个结果目录都以原子方式写入，
+    因此不会残留不完整的目录。
+
+    参数:
+    sources (list[str]): 源器官名称列表。
+    target_organ_name (str): 目标器官名称。
+    angles (list[tuple[float, float]]): (alpha_deg, theta_deg) 列表。
+    output_dir (str, optional): 结果根目录；多个源器官时在其下按 <source>_to_<target> 分开保存。
+
+    返回:
+    int: 成功保存的结果目录数量。
+    """
+    sources = list(dict.fromkeys(sources))
+    angles = list(dict.fromkeys((float(a), float(t)) for a, t in angles))
+
+    scene_queue = queue.Queue(maxsize=prefetch_scenes)
+    stop_event = threading.Event()
+    loader = threading.Thread(
+        target=_scene_loader,
+        args=(sources, target_organ_name, scene_queue, stop_event),
+        daemon=True
+    )
+    write_slots = threading.BoundedSemaphore(max_pending_writes)
+    executor = ThreadPoolExecutor(max_workers=writer_threads)
+
+    # 写入任务的状态由完成回调维护，无需扫描全部 future
+    state_lock = threading.Lock()
+    in_flight = {}
+    failures = []
+    failed_jobs = []
+    saved_jobs = set()
+    empty_sources = set()
+
+    def write_job(output_path, scene, traced, direction_index, params, ray_direction):
+        try:
+            results = build_results(scene["source_points"], scene["point_names"], traced, direction_index)
+            save_results_atomic(
+                output_path,
+                results,
+                params,
+                ray_direction,
+                scene["skin_mesh_path"],
+                scene["key_points_path"],
+                scene["mapping_path"]
+            )
+        finally:
+            write_slots.release()
+
+    def on_write_done(future):
+        with state_lock:
+            job = in_flight.pop(future)
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                failed_jobs.append(job)
+                failures.append(future.exception())
+            else:
+                saved_jobs.add(job)
+
+    def report_unsaved():
+        """对照完整的任务列表，列出写入失败以及未执行 (未追踪、未提交或已取消) 的方向。"""
+        with state_lock:
+            failed = list(failed_jobs)
+            done = saved_jobs | set(failed)
+        not_attempted = [
+            (source, alpha_deg, theta_deg)
+            for source in sources if source not in empty_sources
+            for alpha_deg, theta_deg in angles
+            if (source, alpha_deg, theta_deg) not in done
+        ]
+        if not failed and not not_attempted:
+            return
+        print(f"以下 {len(failed) + len(not_attempted)} 个方向的结果未能保存 (已保存 {len(done) - len(failed)} 个):")
+        for title, jobs in (("写入失败", failed), ("未执行", not_attempted)):
+            if jobs:
+                print(f"  {title} ({len(jobs)} 个):")
+                for source, alpha_deg, theta_deg in jobs:
+                    print(f"    - {source}: alpha={alpha_deg}, theta={theta_deg}")
+
+    loader.start()
+    try:
+        while True:
+            item = scene_queue.get()
+            if item is _LOADER_DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            source, scene = item
+
+            if len(scene["source_points"]) == 0:
+                print(f"射线追踪未生成任何结果: {source}")
+                empty_sources.add(source)
+                continue
+
+            if output_dir and len(sources) == 1:
+                output_base_dir = Path(output_dir)
+            elif output_dir:
+                output_base_dir = Path(output_dir) / f"{source}_to_{target_organ_name}"
+            else:
+                output_base_dir = RESULTS_DIR / f"{source}_to_{target_organ_name}"
+
+            for start in range(0, len(angles), trace_batch):
+                batch = angles[start:start + trace_batch]
+                print(f"--- 追踪 {source} -> {target_organ_name}: {len(batch)} 个方向 ---")
+                directions = np.array([get_direction_from_angles(a, t) for a, t in batch])
+                traced = trace_rays(scene["skin_mesh"], scene["source_points"], directions)
+
+                for k, (alpha_deg, theta_deg) in enumerate(batch):
+                    write_slots.acquire()
+                    if failures:
+                        write_slots.release()
+                        raise failures[0]
+                    with state_lock:
+                        future = executor.submit(
+                            write_job,
+                            output_base_dir / f"alpha_{alpha_deg}_theta_{theta_deg}",
+                            scene,
+                            traced,
+                            k,
+                            {"alpha_deg": alpha_deg, "theta_deg": theta_deg},
+                            directions[k]
+                        )
+                        in_flight[future] = (source, alpha_deg, theta_deg)
+                    future.add_done_callback(on_write_done)
+    except BaseException:
+        stop_event.set()
+        writer_failed = bool(failures)
+        if not writer_failed:
+            print("出现错误，正在写出已追踪的结果...")
+        executor.shutdown(wait=True, cancel_futures=writer_failed)
+        report_unsaved()
+        raise
+    finally:
+        stop_event.set()
+        loader.join()
+
+    executor.shutdown(wait=True)
+    if failures:
+        report_unsaved()
+        raise failures[0]
+    return len(saved_jobs)
 
 def main():
     parser = argparse.ArgumentParser(
         description="从源器官向目标模型执行参数化射线追踪。"
     )
-    parser.add_argument("--source", required=True, help="源器官的名称 (e.g., 'heart', 'thyroid').")
+    parser.add_argument("--source", required=True, nargs='+', help="源器官的名称，可指定多个 (e.g., 'heart', 'thyroid').")
     parser.add_argument("--target", default="skin", help="目标器官的名称 (默认为 'skin').")
-    parser.add_argument("--alpha", type=float, required=True, help="射线的倾斜角 (alpha)，单位：度。")
-    parser.add_argument("--theta", type=float, required=True, help="射线的方位角 (theta)，单位：度。")
-    parser.add_argument("--output_dir", default=None, help="保存结果的自定义目录。默认为 'output/results/<source>_to_<target>/'")
+    parser.add_argument("--alpha", type=float, required=True, nargs='+', help="射线的倾斜角 (alpha)，单位：度。可指定多个。")
+    parser.add_argument("--theta", type=float, required=True, nargs='+', help="射线的方位角 (theta)，单位：度。可指定多个，与 alpha 做笛卡尔积。")
+    parser.add_argument("--output_dir", default=None, help="保存结果的自定义目录。默认为 'output/results/<source>_to_<target>/'；指定多个源器官时在其下按 <source>_to_<target> 分开保存。")
+    parser.add_argument("--writer_threads", type=int, default=PIPELINE_WRITER_THREADS, help="后台写入结果的线程数。")
 
     args = parser.parse_args()
 
-    # Correctly call run_ray_tracing with organ names
-    results, ray_direction = run_ray_tracing(
+    saved = run_pipeline(
         args.source,
         args.target,
-        args.alpha,
-        args.theta
-    )
-
-    if not results:
-        print("射线追踪未生成任何结果。")
-        return
-
-    # --- Prepare paths for saving results ---
-    source_paths = get_paths(args.source)
-    target_paths = get_paths(args.target)
-    
-    key_points_path = source_paths.get("processed_keypoints")
-    if not key_points_path or not os.path.exists(str(key_points_path)):
-        key_points_path = source_paths['processed_model']
-        
-    skin_mesh_path = target_paths['processed_model']
-    mapping_file = source_paths.get('keypoints_mapping')
-
-    if args.output_dir:
-        output_base_dir = args.output_dir
-    else:
-        output_base_dir = os.path.join(BASE_DIR, "output", "results", f"{args.source}_to_{args.target}")
-        
-    output_path_str = os.path.join(output_base_dir, f"alpha_{args.alpha}_theta_{args.theta}")
-    
-    save_results(
-        output_path_str,
-        results,
-        {"alpha_deg": args.alpha, "theta_deg": args.theta},
-        ray_direction,
-        skin_mesh_path,
-        key_points_path,
-        mapping_file
+        list(product(args.alpha, args.theta)),
+        output_dir=args.output_dir,
+        writer_threads=args.writer_threads
     )
+    print(f"--- 全部完成: 共保存 {saved} 组结果 ---")
 
 if __name__ == "__main__":
     # Add path to src for imports
     sys.path.append(str(Path(__file__).resolve().parent))
-    from config import BASE_DIR
-    main() 
\ No newline at end of file
+    main()